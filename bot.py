@@ -1,4 +1,5 @@
-import os, io, csv, logging, re
+import os, io, csv, logging, re, asyncio, tempfile, time, hashlib, sqlite3
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from pathlib import Path
 from zoneinfo import ZoneInfo  # <-- local time support
@@ -9,14 +10,15 @@ load_dotenv(dotenv_path=Path(__file__).with_name(".env"))
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 
-from openai import OpenAI, AsyncOpenAI
+from openai import AsyncOpenAI
 
 from telegram import Update, File as TgFile
-from telegram.constants import ParseMode
+from telegram.constants import ChatType, ParseMode
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from telegram.error import Forbidden, Conflict
+from telegram.error import Conflict
 
-from storage import Storage, ensure_db
+from sender import SendQueue
+from storage import Storage
 from summarizer import summarize_window, build_keyword_flags
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
@@ -33,14 +35,21 @@ LOCAL_TZ           = os.getenv("LOCAL_TZ", "Asia/Tashkent")  # Uzbekistan time b
 TZ                 = ZoneInfo(LOCAL_TZ)
 
 DB_PATH            = os.getenv("DB_PATH", "data/bot.db")
+# Nightly move of messages older than N days into a separate archive DB (0 = keep all)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_DB_PATH    = os.getenv("ARCHIVE_DB_PATH", str(Path(DB_PATH).with_name("archive.db")))
 DEFAULT_DIGEST_TIME = os.getenv("DEFAULT_DIGEST_TIME", "21:00")
+# /stats window; the user_daily rollup is pruned to this plus one spare day
+STATS_WINDOW_DAYS  = 7
 
 # Behavior toggles
 KEYWORD_REPLY          = os.getenv("KEYWORD_REPLY", "0") == "1"  # public reply on hit? default OFF
 AUTO_REPLY             = os.getenv("AUTO_REPLY", "1") == "1"     # suggest answer for admin DM
+AUTO_REPLY_TIMEOUT     = float(os.getenv("AUTO_REPLY_TIMEOUT", "15"))  # seconds per OpenAI attempt
 DM_ADMIN_ON_KEYWORD    = os.getenv("DM_ADMIN_ON_KEYWORD", "1") == "1"
 DM_ADMIN_ON_SEARCH     = os.getenv("DM_ADMIN_ON_SEARCH", "1") == "1"
 DM_ADMIN_DIGEST        = os.getenv("DM_ADMIN_DIGEST", "1") == "1"
+STORE_PRIVATE_CHATS    = os.getenv("STORE_PRIVATE_CHATS", "0") == "1"  # also log DMs to the bot?
 
 # Event context (helps suggested answers)
 EVENT_CONTEXT      = os.getenv("EVENT_CONTEXT", "")
@@ -57,20 +66,24 @@ TRANSCRIBE_MEDIA = os.getenv("TRANSCRIBE_MEDIA", "1") == "1"
 TRANSCRIBE_MODEL = os.getenv("TRANSCRIBE_MODEL", "gpt-4o-mini-transcribe")
 MAX_MEDIA_MB     = int(os.getenv("MAX_MEDIA_MB", "25"))
 MEDIA_DIR        = os.getenv("MEDIA_DIR", "data/media")
-KEEP_MEDIA       = os.getenv("KEEP_MEDIA", "0") == "1"
-os.makedirs(MEDIA_DIR, exist_ok=True)
+KEEP_MEDIA       = os.getenv("KEEP_MEDIA", "0") == "1"  # also save downloads under MEDIA_DIR
+if KEEP_MEDIA:
+    os.makedirs(MEDIA_DIR, exist_ok=True)
 
 # Optional allow-list of chat IDs (comma-separated)
-ALLOWED_CHAT_IDS = [int(cid) for cid in os.getenv("ALLOWED_CHAT_IDS", "").replace(" ", "").split(",") if cid]
+ALLOWED_CHAT_IDS = frozenset(int(cid) for cid in os.getenv("ALLOWED_CHAT_IDS", "").replace(" ", "").split(",") if cid)
 
 if not TELEGRAM_BOT_TOKEN or not OPENAI_API_KEY:
     raise SystemExit("TELEGRAM_BOT_TOKEN or OPENAI_API_KEY missing")
 
-client  = OpenAI(api_key=OPENAI_API_KEY)       # sync fallback
-aclient = AsyncOpenAI(api_key=OPENAI_API_KEY)  # async for awaited calls
+aclient = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=3)
 
-storage   = Storage(DB_PATH)
-scheduler = AsyncIOScheduler(timezone=LOCAL_TZ)
+storage    = Storage(DB_PATH)
+# A job that starts late on a busy loop still runs (within 5 min) rather than
+# being dropped as missed; coalesce keeps it to one run per due time.
+scheduler  = AsyncIOScheduler(timezone=LOCAL_TZ,
+                              job_defaults={"misfire_grace_time": 300, "coalesce": True})
+send_queue = SendQueue()  # paced outbound notifications (digests, DMs, keyword replies)
 
 INSPIRATIONS = [
     "Bugungi kichik qadamlar ertangi katta g‘alabaga olib boradi. Davom eting! 💪",
@@ -82,79 +95,253 @@ INSPIRATIONS = [
 # =========================
 # Time helpers (LOCAL)
 # =========================
+_HHMM_RE = re.compile(r"\A([01]\d|2[0-3]):[0-5]\d\Z")
+
 def now_local_hhmm() -> str:
     return datetime.now(TZ).strftime("%H:%M")
 
+_day_bounds = (0, 0)  # [start, end) of the current local day, epoch seconds
+
 def local_midnight_ts() -> int:
-    n = datetime.now(TZ)
-    return int(n.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+    # Recomputed once per local day; a fixed 86400 step would drift on DST days.
+    global _day_bounds
+    now = time.time()
+    if not _day_bounds[0] <= now < _day_bounds[1]:
+        today = datetime.fromtimestamp(now, TZ).date()
+        start = datetime.combine(today, datetime.min.time(), TZ)
+        end = datetime.combine(today + timedelta(days=1), datetime.min.time(), TZ)
+        _day_bounds = (int(start.timestamp()), int(end.timestamp()))
+    return _day_bounds[0]
 
 # =========================
 # Helpers
 # =========================
 def allow_chat(chat_id: int) -> bool:
-    return (chat_id in ALLOWED_CHAT_IDS) if ALLOWED_CHAT_IDS else True
+    return not ALLOWED_CHAT_IDS or chat_id in ALLOWED_CHAT_IDS
+
+_GROUP_TYPES = (ChatType.GROUP, ChatType.SUPERGROUP)
 
-async def dm_admin(chat_id: int, text: str, app: Application, parse_mode=None):
+def store_chat_type(chat_type: str) -> bool:
+    return chat_type in _GROUP_TYPES or (STORE_PRIVATE_CHATS and chat_type == ChatType.PRIVATE)
+
+def dm_admin(chat_id: int, text: str, parse_mode=None) -> bool:
+    """Queue a DM to the chat's admin; False if no admin is configured."""
     admin_id = storage.get_admin(chat_id)
     if not admin_id:
         return False
-    try:
-        await app.bot.send_message(chat_id=admin_id, text=text, parse_mode=parse_mode)
-        return True
-    except Forbidden:
-        log.warning("Cannot DM admin %s. Ask them to /start the bot in DM.", admin_id)
-        return False
-    except Exception as e:
-        log.warning("DM admin failed: %s", e)
-        return False
+    send_queue.put(admin_id, text, parse_mode)
+    return True
 
 def format_user(u) -> str:
     return f"@{getattr(u, 'username', None)}" if getattr(u, "username", None) else str(getattr(u, "id", ""))
 
+ANSWER_SYSTEM_PROMPT = (
+    "You are a concise assistant for a Telegram event group. "
+    "Answer in 2–3 short sentences, helpful and precise. "
+    "Use the provided EVENT CONTEXT if relevant. If unsure, suggest what info is needed."
+)
+# EVENT_CONTEXT is fixed at startup, so format it into the prompt only once.
+_ANSWER_PREFIX = f"EVENT CONTEXT:\n{EVENT_CONTEXT}\n\nQUESTION:\n"
+
+# Event groups keep asking the same few questions; remember recent answers.
+# Failures (empty answers) are only remembered for ANSWER_RETRY_AFTER seconds.
+ANSWER_CACHE_MAX   = 256
+ANSWER_RETRY_AFTER = 60
+_answer_cache: OrderedDict[bytes, tuple[str, float]] = OrderedDict()
+
+def _answer_key(text: str) -> bytes:
+    norm = " ".join(text.lower().split())
+    return hashlib.blake2b(norm.encode("utf-8"), digest_size=16).digest()
+
 async def suggested_answer(user_msg: str) -> str:
     if not AUTO_REPLY:
         return ""
-    sys = (
-        "You are a concise assistant for a Telegram event group. "
-        "Answer in 2–3 short sentences, helpful and precise. "
-        "Use the provided EVENT CONTEXT if relevant. If unsure, suggest what info is needed."
-    )
-    content = f"EVENT CONTEXT:\n{EVENT_CONTEXT}\n\nQUESTION:\n{user_msg}\n\nProvide a short, direct answer."
+    key = _answer_key(user_msg)
+    cached = _answer_cache.get(key)
+    if cached and (cached[0] or time.monotonic() - cached[1] < ANSWER_RETRY_AFTER):
+        _answer_cache.move_to_end(key)
+        return cached[0]
+    content = f"{_ANSWER_PREFIX}{user_msg}\n\nProvide a short, direct answer."
     try:
+        # The client itself retries connection errors, 429s and 5xx with
+        # exponential backoff + jitter; the timeout bounds each attempt.
         resp = await aclient.chat.completions.create(
             model=OPENAI_MODEL,
             temperature=0.2,
-            messages=[{"role":"system","content":sys},{"role":"user","content":content}]
+            messages=[{"role":"system","content":ANSWER_SYSTEM_PROMPT},{"role":"user","content":content}],
+            timeout=AUTO_REPLY_TIMEOUT,
         )
-        return resp.choices[0].message.content.strip()
+        ans = resp.choices[0].message.content.strip()
     except Exception as e:
-        log.warning("Auto-reply (async) failed: %s", e)
-    try:
-        resp = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            temperature=0.2,
-            messages=[{"role":"system","content":sys},{"role":"user","content":content}]
-        )
-        return resp.choices[0].message.content.strip()
-    except Exception as e2:
-        log.warning("Auto-reply (sync fallback) failed: %s", e2)
-        return ""
+        log.warning("Auto-reply failed: %s", e)
+        ans = ""
+    _answer_cache[key] = (ans, time.monotonic())
+    _answer_cache.move_to_end(key)
+    if len(_answer_cache) > ANSWER_CACHE_MAX:
+        _answer_cache.popitem(last=False)
+    return ans
 
 def _mb(n_bytes: int) -> float:
     return n_bytes / (1024 * 1024.0)
 
-async def transcribe_file(path: str) -> str:
+async def transcribe_bytes(data: io.BytesIO, fname: str) -> str:
     if not TRANSCRIBE_MEDIA:
         return ""
     try:
-        with open(path, "rb") as f:
-            trx = await aclient.audio.transcriptions.create(model=TRANSCRIBE_MODEL, file=f)
+        # The upload streams the buffer as-is; no bytes copy of the file.
+        trx = await aclient.audio.transcriptions.create(model=TRANSCRIBE_MODEL, file=(fname, data))
         return (getattr(trx, "text", "") or "").strip()
     except Exception as e:
-        log.warning("Transcription failed for %s: %s", path, e)
+        log.warning("Transcription failed for %s: %s", fname, e)
         return ""
 
+def _save_media(data: io.BytesIO, fname: str):
+    with data.getbuffer() as view:
+        Path(MEDIA_DIR, fname).write_bytes(view)
+
+DIGEST_CACHE_TTL = 24 * 3600  # seconds
+
+def _cached_digest_lookup(chat_id: int, since: int, period_label: str):
+    """Fingerprint the window and look up its cached digest in one worker hop.
+    Returns (None, None) for an empty window, else (cache key, digest or None)."""
+    count, first_id, last_id = storage.window_fingerprint(chat_id, since)
+    if not count:
+        return None, None
+    key = f"{OPENAI_MODEL}:{period_label}:{chat_id}:{count}:{first_id}:{last_id}"
+    return key, storage.get_cached_digest(key)
+
+async def build_digest(chat_id: int, since: int, period_label: str) -> str | None:
+    """Summarize the window, reusing a cached digest if its messages are unchanged.
+    Returns None when the window is empty."""
+    key, digest = await asyncio.to_thread(_cached_digest_lookup, chat_id, since, period_label)
+    if key is None:
+        return None
+    if digest is None:
+        # Rows are streamed straight into the prompt blocks on a worker thread.
+        lines = storage.iter_digest_lines(chat_id, since)
+        digest = await summarize_window(aclient, OPENAI_MODEL, lines, period_label=period_label)
+        await asyncio.to_thread(storage.put_cached_digest, key, digest, int(time.time()))
+    return digest
+
+async def purge_digest_cache():
+    cutoff = int(time.time()) - DIGEST_CACHE_TTL
+    await asyncio.to_thread(storage.purge_digest_cache, cutoff)
+
+async def archive_old_messages():
+    cutoff = int(time.time()) - ARCHIVE_AFTER_DAYS * 86400
+    try:
+        moved = await asyncio.to_thread(storage.archive_messages, cutoff, ARCHIVE_DB_PATH)
+    except Exception as e:
+        log.warning("Archiving messages failed: %s", e)
+        return
+    if moved:
+        log.info("Archived %d messages older than %d days", moved, ARCHIVE_AFTER_DAYS)
+
+async def prune_rollups():
+    cutoff = int(time.time()) - (STATS_WINDOW_DAYS + 1) * 86400
+    try:
+        await asyncio.to_thread(storage.prune_user_daily, cutoff)
+    except Exception as e:
+        log.warning("Pruning user_daily failed: %s", e)
+
+async def analyze_db():
+    try:
+        await asyncio.to_thread(storage.analyze)
+    except Exception as e:
+        log.warning("Nightly ANALYZE failed: %s", e)
+
+# =========================
+# Write-behind message queue
+# =========================
+WRITE_BATCH_MAX   = 500
+WRITE_FLUSH_EVERY = 0.2  # seconds
+WRITE_LOCK_RETRIES = 4    # backoff 0.5s, 1s, 2s, 4s (on top of sqlite's 5s busy wait)
+
+_write_q: asyncio.Queue = asyncio.Queue()
+
+def queue_message(chat_id: int, message_id: int, user_id, username, text: str, date: int,
+                  matched: str | None = None):
+    """`matched` is the comma-joined keyword list; the hit row is written in the
+    same transaction as the message."""
+    _write_q.put_nowait((chat_id, message_id, user_id, username, text, date, matched))
+
+def _drain_writes(rows: list) -> list:
+    while len(rows) < WRITE_BATCH_MAX:
+        try:
+            rows.append(_write_q.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return rows
+
+def _insert_rows(rows: list):
+    msgs = [r[:6] for r in rows]
+    hits = [(c, m, uid, uname, matched, text, date)
+            for c, m, uid, uname, text, date, matched in rows if matched]
+    storage.insert_messages(msgs, hits)
+
+def _is_locked(e: Exception) -> bool:
+    return isinstance(e, sqlite3.OperationalError) and "locked" in str(e)
+
+def _write_batch(rows: list) -> list:
+    """Write a batch; returns the rows still blocked by a lock so the caller
+    can re-queue them. Any other failure falls back to row-by-row inserts so
+    one bad row can't take the whole batch with it."""
+    for attempt in range(WRITE_LOCK_RETRIES + 1):
+        try:
+            _insert_rows(rows)
+            return []
+        except Exception as e:
+            if not _is_locked(e):
+                log.error("Batch insert of %d messages failed, retrying per row: %s", len(rows), e)
+                break
+            if attempt == WRITE_LOCK_RETRIES:
+                log.error("Database locked; re-queueing %d messages", len(rows))
+                return rows
+            time.sleep(0.5 * 2 ** attempt)
+    blocked = []
+    for row in rows:
+        try:
+            _insert_rows([row])
+        except Exception as e:
+            if _is_locked(e):
+                blocked.append(row)
+            else:
+                log.error("Dropping message %s in chat %s: %s", row[1], row[0], e)
+    return blocked
+
+async def _writer_loop():
+    # One executemany/commit per batch instead of one fsync per message.
+    while True:
+        rows = [await _write_q.get()]
+        try:
+            await asyncio.sleep(WRITE_FLUSH_EVERY)
+        except asyncio.CancelledError:
+            _requeue(_write_batch(_drain_writes(rows)))
+            raise
+        _requeue(await asyncio.to_thread(_write_batch, _drain_writes(rows)))
+
+def _requeue(rows: list):
+    for row in rows:
+        _write_q.put_nowait(row)
+
+_writer_task: asyncio.Task | None = None
+
+def _start_writer():
+    global _writer_task
+    _writer_task = asyncio.create_task(_writer_loop())
+
+async def _flush_writes():
+    if _writer_task:
+        _writer_task.cancel()
+        try:
+            await _writer_task
+        except asyncio.CancelledError:
+            pass
+    while not _write_q.empty():
+        lost = _write_batch(_drain_writes([]))
+        if lost:
+            log.error("Shutting down with %d unwritten messages (database locked)", len(lost))
+
 # =========================
 # Commands
 # =========================
@@ -209,11 +396,12 @@ async def set_inspire(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     time_str = context.args[0]
-    if not re.match(r"^\d{2}:\d{2}$", time_str):
+    if not _HHMM_RE.match(time_str):
         await update.message.reply_text("HH:MM formatida kiriting, masalan 21:00")
         return
     threshold = int(context.args[1]) if len(context.args) > 1 else DEFAULT_INSPIRE_THRESHOLD
     storage.set_inspire(update.effective_chat.id, time_str, threshold)
+    schedule_chat(update.effective_chat.id)
     await update.message.reply_text(f"Inspire sozlandi: vaqt={time_str}, threshold={threshold}")
 
 async def chatid(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -228,42 +416,41 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not query:
         await update.message.reply_text("Foydalanish: /search so‘rov")
         return
-    results = storage.search(update.effective_chat.id, query, limit=20)
-    if DM_ADMIN_ON_SEARCH and storage.get_admin(update.effective_chat.id):
+    to_admin = DM_ADMIN_ON_SEARCH and storage.get_admin(update.effective_chat.id)
+    width = 300 if to_admin else 200
+    results = await asyncio.to_thread(storage.search, update.effective_chat.id, query,
+                                      limit=20, snippet_chars=width)
+    if to_admin:
         if not results:
-            await dm_admin(update.effective_chat.id, f"[Search] '{query}': hech narsa topilmadi.", context.application)
+            dm_admin(update.effective_chat.id, f"[Search] '{query}': hech narsa topilmadi.")
             await update.message.reply_text("Qidiruv natijalari admin DM'ga yuborildi.")
             return
-        lines = [f"[Search] '{query}' — {len(results)} natija:"]
-        for r in results:
-            ts = datetime.fromtimestamp(r["date"]).strftime("%Y-%m-%d %H:%M")
-            user = f"@{r['username']}" if r["username"] else r["user_id"]
-            snippet = (r["text"][:300] + "…") if len(r["text"]) > 300 else r["text"]
-            lines.append(f"• {ts} — {user}: {snippet}")
-        await dm_admin(update.effective_chat.id, "\n".join(lines), context.application)
+        dm_admin(update.effective_chat.id,
+                 f"[Search] '{query}' — {len(results)} natija:\n" + _format_results(results, width))
         await update.message.reply_text("Qidiruv natijalari admin DM'ga yuborildi.")
     else:
         if not results:
             await update.message.reply_text("Hech narsa topilmadi.")
             return
-        lines = []
-        for r in results:
-            ts = datetime.fromtimestamp(r["date"]).strftime("%Y-%m-%d %H:%M")
-            user = f"@{r['username']}" if r["username"] else r["user_id"]
-            snippet = (r["text"][:200] + "…") if len(r["text"]) > 200 else r["text"]
-            lines.append(f"• {ts} — {user}: {snippet}")
-        await update.message.reply_text("\n".join(lines))
+        await update.message.reply_text(_format_results(results, width))
+
+def _format_results(rows, width: int) -> str:
+    # snippets come back clipped to width+1 chars, so a longer one was cut
+    return "\n".join(
+        f"• {r['ts']} — {'@' + r['username'] if r['username'] else r['user_id']}: "
+        f"{r['snippet'][:width] + '…' if len(r['snippet']) > width else r['snippet']}"
+        for r in rows
+    )
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not allow_chat(update.effective_chat.id):
         return
-    since = int((datetime.now(TZ) - timedelta(days=7)).timestamp())
-    top = storage.top_users(update.effective_chat.id, since, limit=10)
-    total = storage.count_messages(update.effective_chat.id, since)
+    since = int(time.time()) - STATS_WINDOW_DAYS * 86400
+    total, top = await asyncio.to_thread(storage.user_stats, update.effective_chat.id, since, limit=10)
     if not total:
-        await update.message.reply_text("7 kunlik statistika bo‘sh.")
+        await update.message.reply_text(f"{STATS_WINDOW_DAYS} kunlik statistika bo‘sh.")
         return
-    lines = [f"Oxirgi 7 kunda jami xabarlar: {total}", "Top ishtirokchilar:"]
+    lines = [f"Oxirgi {STATS_WINDOW_DAYS} kunda jami xabarlar: {total}", "Top ishtirokchilar:"]
     for u in top:
         uname = f"@{u['username']}" if u["username"] else u["user_id"]
         lines.append(f"• {uname} — {u['cnt']} ta")
@@ -273,22 +460,20 @@ async def digest_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not allow_chat(update.effective_chat.id):
         return
     since = local_midnight_ts()
-    msgs = storage.get_messages(update.effective_chat.id, since)
-    if not msgs:
+    digest = await build_digest(update.effective_chat.id, since, "(bugun)")
+    if digest is None:
         await update.message.reply_text("Bugun uchun xabarlar yo‘q.")
         return
-    digest = await summarize_window(client, OPENAI_MODEL, msgs, period_label="(bugun)")
     await update.message.reply_text(digest, parse_mode=ParseMode.MARKDOWN)
 
 async def digest_week(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not allow_chat(update.effective_chat.id):
         return
-    since = int((datetime.now(TZ) - timedelta(days=7)).timestamp())
-    msgs = storage.get_messages(update.effective_chat.id, since)
-    if not msgs:
+    since = int(time.time()) - 7 * 86400
+    digest = await build_digest(update.effective_chat.id, since, "(7 kun)")
+    if digest is None:
         await update.message.reply_text("7 kunlik xabarlar yo‘q.")
         return
-    digest = await summarize_window(client, OPENAI_MODEL, msgs, period_label="(7 kun)")
     await update.message.reply_text(digest, parse_mode=ParseMode.MARKDOWN)
 
 async def digest_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -299,10 +484,11 @@ async def digest_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Hozirgi kunlik digest vaqti: {cur}\nNamuna: /digest_time 21:30")
         return
     time_str = context.args[0]
-    if not re.match(r"^\d{2}:\d{2}$", time_str):
+    if not _HHMM_RE.match(time_str):
         await update.message.reply_text("Iltimos HH:MM formatida kiriting, masalan: 21:30")
         return
     storage.set_digest_time(update.effective_chat.id, time_str)
+    schedule_chat(update.effective_chat.id)
     await update.message.reply_text(f"Kunlik digest vaqti yangilandi: {time_str}")
 
 async def show_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -324,7 +510,7 @@ async def set_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg  = update.effective_message
     chat = update.effective_chat
-    if not allow_chat(chat.id):
+    if not store_chat_type(chat.type) or not allow_chat(chat.id):
         return
 
     file_id, ext, size_bytes, label = None, None, 0, None
@@ -354,17 +540,24 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         log.warning("Media skipped (%.1f MB > limit %d MB)", _mb(size_bytes), MAX_MEDIA_MB)
         return
 
-    # download
-    try:
-        tgfile: TgFile = await context.bot.get_file(file_id)
+    # download into memory (nothing to fetch if we neither transcribe nor keep it)
+    transcript = ""
+    if TRANSCRIBE_MEDIA or KEEP_MEDIA:
         fname = f"{chat.id}_{msg.message_id}{ext}"
-        path  = os.path.join(MEDIA_DIR, fname)
-        await tgfile.download_to_drive(custom_path=path)
-    except Exception as e:
-        log.warning("Download failed: %s", e)
-        return
-
-    transcript = await transcribe_file(path)
+        try:
+            tgfile: TgFile = await context.bot.get_file(file_id)
+            data = io.BytesIO()
+            await tgfile.download_to_memory(data)
+            data.seek(0)
+        except Exception as e:
+            log.warning("Download failed: %s", e)
+            return
+        if KEEP_MEDIA:
+            try:
+                await asyncio.to_thread(_save_media, data, fname)
+            except Exception as e:
+                log.warning("Saving media %s failed: %s", fname, e)
+        transcript = await transcribe_bytes(data, fname)
     parts = ["[media]", label]
     if caption:
         parts.append(caption)
@@ -372,123 +565,123 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parts.append(f"(transcript) {transcript}")
     text_to_store = " ".join([p for p in parts if p]).strip()
 
-    storage.insert_message(
+    user = msg.from_user
+    user_id = user.id if user else None
+    username = user.username if user and user.username else None
+    date = int(msg.date.timestamp()) if msg.date else int(time.time())
+    # keyword detection on caption/transcript
+    kws  = storage.get_keywords(chat.id)
+    hits = build_keyword_flags(text_to_store, kws) if kws else []
+
+    ensure_chat_scheduled(chat.id)
+    queue_message(
         chat_id=chat.id,
         message_id=msg.message_id,
-        user_id=msg.from_user.id if msg.from_user else None,
-        username=msg.from_user.username if msg.from_user and msg.from_user.username else None,
+        user_id=user_id,
+        username=username,
         text=text_to_store if text_to_store else label,
-        date=int(msg.date.timestamp()) if msg.date else int(datetime.now(TZ).timestamp())
+        date=date,
+        matched=",".join(hits) if hits else None,
     )
 
-    # keyword detection on caption/transcript
-    kws  = storage.get_keywords(chat.id) or ""
-    hits = build_keyword_flags(text_to_store, kws)
     if hits:
-        try:
-            storage.insert_keyword_hit(
-                chat_id=chat.id,
-                message_id=msg.message_id,
-                user_id=msg.from_user.id if msg.from_user else None,
-                username=msg.from_user.username if msg.from_user and msg.from_user.username else None,
-                matched=",".join(hits),
-                text=text_to_store,
-                date=int(msg.date.timestamp()) if msg.date else int(datetime.now(TZ).timestamp())
-            )
-        except Exception as e:
-            log.debug("insert_keyword_hit failed: %s", e)
-
         if DM_ADMIN_ON_KEYWORD and storage.get_admin(chat.id):
             ans = await suggested_answer(text_to_store)
             dm_text = (f"[Keyword] {', '.join(hits)}\n"
                        f"Chat: {chat.id}\n"
-                       f"User: {format_user(msg.from_user)}\n"
+                       f"User: {format_user(user)}\n"
                        f"Msg: {text_to_store}\n\n"
                        f"Suggested answer:\n{ans or '(no suggestion)'}")
-            await dm_admin(chat.id, dm_text, context.application)
+            dm_admin(chat.id, dm_text)
 
         if KEYWORD_REPLY:
-            await msg.reply_text("Topilgan kalit so‘zlar: " + ", ".join(hits))
-
-    if not KEEP_MEDIA:
-        try:
-            os.remove(path)
-        except Exception:
-            pass
+            send_queue.put(chat.id, "Topilgan kalit so‘zlar: " + ", ".join(hits), reply_to=msg.message_id)
 
 # =========================
 # Text messages
 # =========================
 async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg  = update.effective_message
+    msg = update.effective_message
+    if not msg or not msg.text:
+        return
     chat = update.effective_chat
-    if not allow_chat(chat.id) or not msg or not msg.text:
+    if not store_chat_type(chat.type) or not allow_chat(chat.id):
         return
 
-    storage.insert_message(
+    user = msg.from_user
+    user_id = user.id if user else None
+    username = user.username if user and user.username else None
+    date = int(msg.date.timestamp()) if msg.date else int(time.time())
+    kws = storage.get_keywords(chat.id)
+    hits = build_keyword_flags(msg.text, kws) if kws else []
+
+    ensure_chat_scheduled(chat.id)
+    queue_message(
         chat_id=chat.id,
         message_id=msg.message_id,
-        user_id=msg.from_user.id if msg.from_user else None,
-        username=msg.from_user.username if msg.from_user and msg.from_user.username else None,
+        user_id=user_id,
+        username=username,
         text=msg.text,
-        date=int(msg.date.timestamp()) if msg.date else int(datetime.now(TZ).timestamp())
+        date=date,
+        matched=",".join(hits) if hits else None,
     )
 
-    kws = storage.get_keywords(chat.id) or ""
-    hits = build_keyword_flags(msg.text, kws)
     if hits:
-        try:
-            storage.insert_keyword_hit(
-                chat_id=chat.id,
-                message_id=msg.message_id,
-                user_id=msg.from_user.id if msg.from_user else None,
-                username=msg.from_user.username if msg.from_user and msg.from_user.username else None,
-                matched=",".join(hits),
-                text=msg.text,
-                date=int(msg.date.timestamp()) if msg.date else int(datetime.now(TZ).timestamp())
-            )
-        except Exception as e:
-            log.debug("insert_keyword_hit failed: %s", e)
-
         if DM_ADMIN_ON_KEYWORD and storage.get_admin(chat.id):
             ans = await suggested_answer(msg.text)
             text = (f"[Keyword] {', '.join(hits)}\n"
                     f"Chat: {chat.id}\n"
-                    f"User: {format_user(msg.from_user)}\n"
+                    f"User: {format_user(user)}\n"
                     f"Msg: {msg.text}\n\n"
                     f"Suggested answer:\n{ans or '(no suggestion)'}")
-            await dm_admin(chat.id, text, context.application)
+            dm_admin(chat.id, text)
 
         if KEYWORD_REPLY:
-            await msg.reply_text("Topilgan kalit so‘zlar: " + ", ".join(hits))
+            send_queue.put(chat.id, "Topilgan kalit so‘zlar: " + ", ".join(hits), reply_to=msg.message_id)
 
 # =========================
 # Extras: hits stats / export / inspire debug
 # =========================
 async def hits_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
     since = local_midnight_ts()
-    n = storage.count_hits(update.effective_chat.id, since)
+    n = await asyncio.to_thread(storage.count_hits, update.effective_chat.id, since)
     await update.message.reply_text(f"Bugun kalit so‘z topilgan xabarlar: {n}")
 
+def _hits_csv(chat_id: int, since: int):
+    """Write hits straight from the cursor into a spooled file; returns (row count, file at 0)."""
+    f = tempfile.SpooledTemporaryFile(max_size=1_000_000, mode="w+b")
+    tw = io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+    w = csv.writer(tw, quoting=csv.QUOTE_ALL)
+    w.writerow(["datetime_local","user","matched_keywords","message"])
+    n = 0
+    minute, ts = None, ""
+    for r in storage.iter_hits(chat_id, since):
+        # rows come ordered by date, so consecutive hits usually share a minute
+        if r["date"] // 60 != minute:
+            minute = r["date"] // 60
+            ts = datetime.fromtimestamp(r["date"], TZ).strftime("%Y-%m-%d %H:%M")
+        user = ("@" + r["username"]) if r["username"] else (str(r["user_id"] or ""))
+        w.writerow([ts, user, r["matched"], r["text"]])
+        n += 1
+    tw.flush()
+    tw.detach()
+    f.seek(0)
+    return n, f
+
 async def export_hits(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         days = int(context.args[0]) if context.args else 7
     except:
         days = 7
-    since = int((datetime.now(TZ) - timedelta(days=days)).timestamp())
-    rows = storage.get_hits(update.effective_chat.id, since)
-    if not rows:
+    since = int(time.time()) - days * 86400
+    n, f = await asyncio.to_thread(_hits_csv, update.effective_chat.id, since)
+    if not n:
+        f.close()
         await update.message.reply_text(f"Oxirgi {days} kunda kalit so‘z topilmadi.")
         return
-    buf = io.StringIO(); w = csv.writer(buf)
-    w.writerow(["datetime_local","user","matched_keywords","message"])
-    for r in rows:
-        ts = datetime.fromtimestamp(r["date"], TZ).strftime("%Y-%m-%d %H:%M")
-        user = ("@" + r["username"]) if r.get("username") else (str(r.get("user_id") or ""))
-        w.writerow([ts, user, r["matched"], r["text"].replace("\n"," ")])
-    data = buf.getvalue().encode("utf-8-sig"); bio = io.BytesIO(data); bio.name = f"keyword_hits_{days}d.csv"
-    await update.message.reply_document(document=bio, filename=bio.name,
-        caption=f"Kalit so‘zlar bo‘yicha hitlar — oxirgi {days} kun")
+    with f:
+        await update.message.reply_document(document=f, filename=f"keyword_hits_{days}d.csv",
+            caption=f"Kalit so‘zlar bo‘yicha hitlar — oxirgi {days} kun")
 
 # Inspire debug helpers
 async def debug_inspire(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -498,7 +691,7 @@ async def debug_inspire(update: Update, context: ContextTypes.DEFAULT_TYPE):
     insp_thr = insp_thr or DEFAULT_INSPIRE_THRESHOLD
     now = now_local_hhmm()
     since = local_midnight_ts()
-    cnt = storage.count_messages(chat_id, since)
+    cnt = await asyncio.to_thread(storage.count_messages, chat_id, since)
     would = (insp_time == now and cnt >= insp_thr)
     await update.message.reply_text(
         "Inspire debug:\n"
@@ -517,39 +710,84 @@ async def send_inspire_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # =========================
 # Scheduler (daily digest + inspiration + admin DM)
 # =========================
-def setup_scheduler(app: Application):
-    async def minute_tick():
-        now_local = now_local_hhmm()
-        for chat_id in storage.all_chats():
-            # Daily digest to group (local time)
-            desired = storage.get_digest_time(chat_id) or DEFAULT_DIGEST_TIME
-            if desired == now_local:
-                since = local_midnight_ts()
-                msgs = storage.get_messages(chat_id, since)
-                if msgs:
-                    digest = await summarize_window(client, OPENAI_MODEL, msgs, period_label="(kunlik)")
-                    try:
-                        await app.bot.send_message(chat_id=chat_id, text=digest, parse_mode=ParseMode.MARKDOWN)
-                    except Exception as e:
-                        log.warning("Send digest to %s failed: %s", chat_id, e)
-                    if DM_ADMIN_DIGEST and storage.get_admin(chat_id):
-                        await dm_admin(chat_id, f"[Daily Digest] Chat {chat_id}\n\n{digest}", app, parse_mode=ParseMode.MARKDOWN)
-
-            # Inspiration (local time + local midnight counter)
-            insp_time, insp_thr = storage.get_inspire(chat_id)
-            insp_time = insp_time or DEFAULT_INSPIRE_TIME
-            insp_thr  = insp_thr or DEFAULT_INSPIRE_THRESHOLD
-            if insp_time == now_local:
-                since = local_midnight_ts()
-                msg_count = storage.count_messages(chat_id, since)
-                if msg_count >= insp_thr:
-                    try:
-                        msg = INSPIRATIONS[msg_count % len(INSPIRATIONS)]
-                        await app.bot.send_message(chat_id=chat_id, text=msg)
-                    except Exception as e:
-                        log.warning("Send inspiration to %s failed: %s", chat_id, e)
-
-    scheduler.add_job(minute_tick, CronTrigger(minute="*"))
+# Digests for many chats can come due on the same minute; each runs as its own
+# job, so cap how many summarize concurrently to stay within OpenAI rate limits.
+_digest_sem = asyncio.Semaphore(5)
+
+async def send_daily_digest(chat_id: int):
+    since = local_midnight_ts()
+    try:
+        async with _digest_sem:
+            digest = await build_digest(chat_id, since, "(kunlik)")
+    except Exception as e:
+        log.warning("Daily digest for %s failed: %s", chat_id, e)
+        return
+    if digest is None:
+        return
+    send_queue.put(chat_id, digest, ParseMode.MARKDOWN)
+    if DM_ADMIN_DIGEST:
+        dm_admin(chat_id, f"[Daily Digest] Chat {chat_id}\n\n{digest}", parse_mode=ParseMode.MARKDOWN)
+
+async def send_inspiration(chat_id: int):
+    _, insp_thr = storage.get_inspire(chat_id)
+    insp_thr = insp_thr or DEFAULT_INSPIRE_THRESHOLD
+    since = local_midnight_ts()
+    msg_count = await asyncio.to_thread(storage.count_messages, chat_id, since)
+    if msg_count >= insp_thr:
+        send_queue.put(chat_id, INSPIRATIONS[msg_count % len(INSPIRATIONS)])
+
+def _cron_at(time_str: str) -> CronTrigger:
+    h, m = time_str.split(":")
+    return CronTrigger(hour=int(h), minute=int(m), timezone=LOCAL_TZ)
+
+def _chat_trigger(chat_id: int, kind: str, time_str: str | None, default: str) -> CronTrigger:
+    """Trigger for a stored HH:MM; older rows may hold out-of-range times
+    (e.g. "25:99"), which fall back to the default instead of failing."""
+    if time_str:
+        try:
+            return _cron_at(time_str)
+        except ValueError as e:
+            log.warning("Bad %s time %r for chat %s, using %s: %s", kind, time_str, chat_id, default, e)
+    return _cron_at(default)
+
+_scheduled_chats: set[int] = set()
+
+def _register_chat_jobs(chat_id: int, digest_at: str | None, insp_at: str | None):
+    # Each job is registered on its own, so one bad time can't cost the other.
+    jobs = (
+        (send_daily_digest, "digest", digest_at, DEFAULT_DIGEST_TIME),
+        (send_inspiration, "inspire", insp_at, DEFAULT_INSPIRE_TIME),
+    )
+    for func, kind, at, default in jobs:
+        try:
+            trigger = _chat_trigger(chat_id, kind, at, default)
+        except ValueError as e:
+            log.error("Cannot schedule %s for chat %s: %s", kind, chat_id, e)
+            continue
+        scheduler.add_job(func, trigger, args=[chat_id], id=f"{kind}:{chat_id}", replace_existing=True)
+    _scheduled_chats.add(chat_id)
+
+def schedule_chat(chat_id: int):
+    """(Re)register this chat's digest and inspiration jobs at their local HH:MM."""
+    insp_at, _ = storage.get_inspire(chat_id)
+    _register_chat_jobs(chat_id, storage.get_digest_time(chat_id), insp_at)
+
+def ensure_chat_scheduled(chat_id: int):
+    if chat_id not in _scheduled_chats:
+        schedule_chat(chat_id)
+
+def setup_scheduler():
+    for chat_id, digest_at, insp_at in storage.all_schedules():
+        _register_chat_jobs(chat_id, digest_at, insp_at)
+    scheduler.add_job(purge_digest_cache, CronTrigger(minute=0, timezone=LOCAL_TZ),
+                      id="digest_cache_purge", replace_existing=True)
+    if ARCHIVE_AFTER_DAYS > 0:
+        scheduler.add_job(archive_old_messages, CronTrigger(hour=3, minute=0, timezone=LOCAL_TZ),
+                          id="db_archive", replace_existing=True)
+    scheduler.add_job(prune_rollups, CronTrigger(hour=3, minute=15, timezone=LOCAL_TZ),
+                      id="prune_rollups", replace_existing=True)
+    scheduler.add_job(analyze_db, CronTrigger(hour=3, minute=30, timezone=LOCAL_TZ),
+                      id="db_analyze", replace_existing=True)
     scheduler.start()
 
 # =========================
@@ -564,41 +802,61 @@ async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
 # =========================
 # App wiring
 # =========================
-def build_app() -> Application:
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-
-    # Commands
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("whoami", whoami))
-    app.add_handler(CommandHandler("set_admin", set_admin))
-    app.add_handler(CommandHandler("set_inspire", set_inspire))
-
-    app.add_handler(CommandHandler("chatid", chatid))
-    app.add_handler(CommandHandler("search", search))
-    app.add_handler(CommandHandler("stats", stats))
-    app.add_handler(CommandHandler("digest_today", digest_today))
-    app.add_handler(CommandHandler("digest_week", digest_week))
-    app.add_handler(CommandHandler("digest_time", digest_time))
-    app.add_handler(CommandHandler("keywords", show_keywords))
-    app.add_handler(CommandHandler("set_keywords", set_keywords))
-    app.add_handler(CommandHandler("hits_today", hits_today))
-    app.add_handler(CommandHandler("export_hits", export_hits))
+async def _on_startup(app: Application):
+    _start_writer()
+    send_queue.start(app.bot)
+
+async def _on_stop(app: Application):
+    # post_stop runs before Application.shutdown() closes the bot's HTTP
+    # client, so queued digests and DMs can still go out.
+    await send_queue.stop()
+
+async def _on_shutdown(app: Application):
+    await _flush_writes()
+    await aclient.close()  # release the shared OpenAI connection pool
+
+COMMANDS = {
+    "start": start,
+    "whoami": whoami,
+    "set_admin": set_admin,
+    "set_inspire": set_inspire,
+
+    "chatid": chatid,
+    "search": search,
+    "stats": stats,
+    "digest_today": digest_today,
+    "digest_week": digest_week,
+    "digest_time": digest_time,
+    "keywords": show_keywords,
+    "set_keywords": set_keywords,
+    "hits_today": hits_today,
+    "export_hits": export_hits,
 
     # Debug helpers
-    app.add_handler(CommandHandler("debug_inspire", debug_inspire))
-    app.add_handler(CommandHandler("send_inspire_now", send_inspire_now))
+    "debug_inspire": debug_inspire,
+    "send_inspire_now": send_inspire_now,
+}
 
-    # Media first, then text
+def build_app() -> Application:
+    app = (Application.builder().token(TELEGRAM_BOT_TOKEN)
+           .post_init(_on_startup).post_stop(_on_stop)
+           .post_shutdown(_on_shutdown).build())
+
+    # Plain messages are by far the most common update, so their handlers go
+    # first: PTB stops at the first match within a group, and neither filter
+    # can match a command (commands are text, and TEXT excludes COMMAND).
     app.add_handler(MessageHandler(filters.VIDEO | filters.VIDEO_NOTE | filters.VOICE | filters.AUDIO, handle_media))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_message))
 
+    for name, fn in COMMANDS.items():
+        app.add_handler(CommandHandler(name, fn))
+
     app.add_error_handler(on_error)
     return app
 
 def main():
-    ensure_db(DB_PATH)
     app = build_app()
-    setup_scheduler(app)
+    setup_scheduler()
     logging.info("Starting polling…")
     app.run_polling(stop_signals=None, close_loop=False, drop_pending_updates=False)
 
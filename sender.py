@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from collections import defaultdict, deque
+from typing import Deque, Dict, Optional, Tuple
+
+from telegram.error import Forbidden, RetryAfter
+
+log = logging.getLogger("chatgpt-secretary")
+
+MAX_MESSAGE_LEN = 4096
+
+# (chat_id, text, parse_mode, reply_to_message_id)
+Item = Tuple[int, str, Optional[str], Optional[int]]
+
+class SendQueue:
+    """Outbound messages paced to Telegram's limits: ~30 msg/s overall and
+    20 msg/min per group. When a chat is rate-limited, its queued plain
+    messages are merged into one (up to 4096 chars) instead of waiting."""
+
+    def __init__(self, per_second: int = 30, group_per_minute: int = 20):
+        self.per_second = per_second
+        self.group_per_minute = group_per_minute
+        self._pending: Deque[Item] = deque()
+        self._wake = asyncio.Event()
+        self._idle = asyncio.Event()  # nothing queued and nothing being sent
+        self._idle.set()
+        self._sent: Deque[float] = deque()
+        self._sent_by_chat: Dict[int, Deque[float]] = defaultdict(deque)
+        self._task: Optional[asyncio.Task] = None
+        self._bot = None
+
+    def put(self, chat_id: int, text: str, parse_mode: Optional[str] = None,
+            reply_to: Optional[int] = None):
+        self._pending.append((chat_id, text, parse_mode, reply_to))
+        self._idle.clear()
+        self._wake.set()
+
+    def start(self, bot):
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, drain_timeout: float = 10.0):
+        """Give queued digests and admin DMs up to drain_timeout seconds to go
+        out, then stop the worker."""
+        if self._task:
+            try:
+                await asyncio.wait_for(self._idle.wait(), drain_timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._pending:
+            log.warning("Send queue stopped with %d unsent messages", len(self._pending))
+
+    # ---------------- internals ----------------
+    def _delay(self, chat_id: int, now: float) -> float:
+        sent = self._sent
+        while sent and now - sent[0] >= 1:
+            sent.popleft()
+        delay = sent[0] + 1 - now if len(sent) >= self.per_second else 0.0
+        if chat_id < 0:  # groups and channels have negative ids
+            chat_sent = self._sent_by_chat[chat_id]
+            while chat_sent and now - chat_sent[0] >= 60:
+                chat_sent.popleft()
+            if len(chat_sent) >= self.group_per_minute:
+                delay = max(delay, chat_sent[0] + 60 - now)
+        return delay
+
+    def _take(self, index: int, now: float) -> Item:
+        """Pop the item at index. Call after recording its send: if the chat
+        still has to wait for its next slot, its later messages ride along."""
+        chat_id, text, parse_mode, reply_to = self._pending[index]
+        del self._pending[index]
+        if reply_to is not None or self._delay(chat_id, now) <= 0:
+            return chat_id, text, parse_mode, reply_to
+        # Merge later messages for the same chat, stopping at the first one that
+        # can't be merged so per-chat order is kept.
+        i = index
+        while i < len(self._pending):
+            c, t, p, r = self._pending[i]
+            if c != chat_id:
+                i += 1
+                continue
+            if p != parse_mode or r is not None or len(text) + 2 + len(t) > MAX_MESSAGE_LEN:
+                break
+            text = f"{text}\n\n{t}"
+            del self._pending[i]
+        return chat_id, text, parse_mode, None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._pending:
+                self._idle.set()
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            now = loop.time()
+            ready, wait = None, None
+            for i, item in enumerate(self._pending):
+                d = self._delay(item[0], now)
+                if d <= 0:
+                    ready = i
+                    break
+                wait = d if wait is None else min(wait, d)
+            if ready is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            chat_id = self._pending[ready][0]
+            self._sent.append(now)
+            if chat_id < 0:
+                self._sent_by_chat[chat_id].append(now)
+            await self._send(self._take(ready, now))
+
+    async def _send(self, item: Item):
+        chat_id, text, parse_mode, reply_to = item
+        try:
+            await self._bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode,
+                                         reply_to_message_id=reply_to)
+        except RetryAfter as e:
+            log.warning("Flood control for %s, retrying in %ss", chat_id, e.retry_after)
+            self._pending.appendleft(item)
+            await asyncio.sleep(e.retry_after)
+        except Forbidden:
+            log.warning("Cannot message %s (bot blocked, or admin has not /start-ed it in DM).", chat_id)
+        except Exception as e:
+            log.warning("Send to %s failed: %s", chat_id, e)
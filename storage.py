@@ -1,6 +1,8 @@
 import os
+import re
 import sqlite3
-from typing import List, Dict, Tuple
+import threading
+from typing import Iterator, List, Dict, Tuple
 
 DB_PATH_DEFAULT = "data/bot.db"
 
@@ -16,11 +18,20 @@ CREATE TABLE IF NOT EXISTS messages (
   text TEXT NOT NULL,
   date INTEGER NOT NULL
 );
-CREATE INDEX IF NOT EXISTS idx_messages_chat_date ON messages(chat_id, date);
+-- Date-window scans (digests, /stats, counts). user_id/username ride along so
+-- /stats' GROUP BY is answered from the index without touching the table;
+-- it supersedes the old (chat_id, date) index.
+CREATE INDEX IF NOT EXISTS idx_messages_chat_date_user ON messages(chat_id, date, user_id, username);
+DROP INDEX IF EXISTS idx_messages_chat_date;
+-- /search @username and /search <user_id> lookups
+CREATE INDEX IF NOT EXISTS idx_messages_chat_user ON messages(chat_id, user_id, date);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_username ON messages(chat_id, username COLLATE NOCASE, date);
 
--- Full-text search
+-- Full-text search. Text lives only in messages (external content), and
+-- detail=none keeps just which rows hold each term: /search needs match +
+-- bm25 rank, not positions, so the index is several times smaller.
 CREATE VIRTUAL TABLE IF NOT EXISTS fts_messages USING fts5(
-  text, content='messages', content_rowid='id'
+  text, content='messages', content_rowid='id', detail=none
 );
 CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
   INSERT INTO fts_messages(rowid, text) VALUES (new.id, new.text);
@@ -49,6 +60,38 @@ CREATE TABLE IF NOT EXISTS keyword_hits (
   date INTEGER NOT NULL
 );
 CREATE INDEX IF NOT EXISTS idx_hits_chat_date ON keyword_hits(chat_id, date);
+
+-- Per-user daily message counts (UTC days) so /stats sums a few rollup rows
+-- instead of grouping every message. NULL ids/names are stored as 0/'' so
+-- they can be part of the key.
+CREATE TABLE IF NOT EXISTS user_daily (
+  chat_id  INTEGER NOT NULL,
+  day      INTEGER NOT NULL,
+  user_id  INTEGER NOT NULL,
+  username TEXT NOT NULL,
+  cnt      INTEGER NOT NULL,
+  PRIMARY KEY (chat_id, day, user_id, username)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS messages_ai_daily AFTER INSERT ON messages BEGIN
+  INSERT INTO user_daily(chat_id, day, user_id, username, cnt)
+  VALUES (new.chat_id, new.date / 86400, IFNULL(new.user_id, 0), IFNULL(new.username, ''), 1)
+  ON CONFLICT(chat_id, day, user_id, username) DO UPDATE SET cnt = cnt + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad_daily AFTER DELETE ON messages BEGIN
+  UPDATE user_daily SET cnt = cnt - 1
+  WHERE chat_id=old.chat_id AND day=old.date / 86400
+    AND user_id=IFNULL(old.user_id, 0) AND username=IFNULL(old.username, '');
+  DELETE FROM user_daily
+  WHERE chat_id=old.chat_id AND day=old.date / 86400
+    AND user_id=IFNULL(old.user_id, 0) AND username=IFNULL(old.username, '') AND cnt<=0;
+END;
+
+-- Generated digests keyed by a fingerprint of the summarized window
+CREATE TABLE IF NOT EXISTS digest_cache (
+  key TEXT PRIMARY KEY,
+  md  TEXT NOT NULL,
+  created_at INTEGER NOT NULL
+);
 """
 
 def _ensure_migrations(con: sqlite3.Connection):
@@ -63,111 +106,277 @@ def _ensure_migrations(con: sqlite3.Connection):
     if "inspire_threshold" not in cols:
         con.execute("ALTER TABLE chat_settings ADD COLUMN inspire_threshold INTEGER DEFAULT 20")
 
+    # Older DBs have a full-detail FTS index; rebuild it once without positions.
+    fts_sql = con.execute("SELECT sql FROM sqlite_master WHERE name='fts_messages'").fetchone()[0]
+    if "detail=none" not in fts_sql:
+        con.execute("DROP TABLE fts_messages")
+        con.execute(
+            "CREATE VIRTUAL TABLE fts_messages USING fts5("
+            "text, content='messages', content_rowid='id', detail=none)"
+        )
+        con.execute("INSERT INTO fts_messages(fts_messages) VALUES ('rebuild')")
+
+    # user_daily is new: backfill it once from existing messages.
+    if (not con.execute("SELECT 1 FROM user_daily LIMIT 1").fetchone()
+            and con.execute("SELECT 1 FROM messages LIMIT 1").fetchone()):
+        con.execute(
+            "INSERT INTO user_daily(chat_id, day, user_id, username, cnt) "
+            "SELECT chat_id, date / 86400, IFNULL(user_id, 0), IFNULL(username, ''), COUNT(*) "
+            "FROM messages GROUP BY 1, 2, 3, 4"
+        )
+
+def _connect(path: str) -> sqlite3.Connection:
+    # Every query here is a fixed parameterized string, so a larger statement
+    # cache keeps all of them prepared for the life of the connection.
+    con = sqlite3.connect(path, cached_statements=256)
+    # Connection-scoped; WAL itself is persisted by SCHEMA. NORMAL only fsyncs
+    # at checkpoints, so a power loss can drop the last commits but not corrupt.
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    # Read-heavy digests: serve pages from the OS page cache via mmap. The page
+    # cache is per connection and each to_thread worker (up to 32) opens its
+    # own, so keep it at ~20 MB; mmap already shares the hot pages.
+    con.execute("PRAGMA mmap_size=268435456")
+    con.execute("PRAGMA cache_size=-20000")
+    return con
+
 def ensure_db(path: str = DB_PATH_DEFAULT):
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    with sqlite3.connect(path) as con:
+    with _connect(path) as con:
+        # Only takes effect on a brand-new file (before the first table);
+        # larger pages pack more rows per read for the digest range scans.
+        con.execute("PRAGMA page_size=8192")
         con.executescript(SCHEMA)
         _ensure_migrations(con)
+        # Give the planner stats for the date-window indexes once; the nightly
+        # Storage.analyze job keeps them fresh after that.
+        if not con.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone():
+            con.execute("ANALYZE")
+
+# `@username` or a bare numeric user id
+_USER_QUERY_RE = re.compile(r"@(\w+)|(\d+)")
+_MAX_SQLITE_INT = 2**63 - 1
+
+_SEARCH_COLS = (
+    "m.id, m.message_id, m.user_id, m.username, m.date, "
+    "strftime('%Y-%m-%d %H:%M', m.date, 'unixepoch', 'localtime') AS ts, "
+    "substr(m.text, 1, ?) AS snippet "
+)
+
+# One fixed statement per single-column setting, so each stays prepared in
+# the connection's statement cache.
+_SETTING_UPSERT = {
+    col: (f"INSERT INTO chat_settings(chat_id, {col}) VALUES (?,?) "
+          f"ON CONFLICT(chat_id) DO UPDATE SET {col}=excluded.{col}")
+    for col in ("digest_time", "keywords", "admin_user_id")
+}
+
+ARCHIVE_BATCH = 5000  # rows moved per archive transaction
+
+# What FTS5's unicode61 tokenizer treats as one token: letters and digits.
+_FTS_TERM_RE = re.compile(r"[^\W_]+")
+
+def fts_query(query: str) -> str:
+    """Split the query the way the index was tokenized and AND the pieces as
+    prefix terms (`"tok"*`). Punctuation never reaches MATCH, and every term
+    is a single token, which detail=none requires (no phrase queries)."""
+    return " ".join(f'"{tok}"*' for tok in _FTS_TERM_RE.findall(query))
 
 class Storage:
     def __init__(self, path: str = DB_PATH_DEFAULT):
         self.path = path
         ensure_db(self.path)
+        self._local = threading.local()
+        # chat_settings only changes through the setters below, so each chat's
+        # row is read once and kept in memory; a setter drops it after writing.
+        self._settings: Dict[int, Tuple] = {}
+        self._settings_lock = threading.Lock()
+
+    def _con(self) -> sqlite3.Connection:
+        """Long-lived connection for the calling thread (handlers run in worker threads)."""
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = self._local.con = _connect(self.path)
+            con.row_factory = sqlite3.Row
+        return con
 
     # ---------------- messages ----------------
-    def insert_message(self, chat_id: int, message_id: int, user_id: int, username: str, text: str, date: int):
-        with sqlite3.connect(self.path) as con:
-            con.execute(
+    def insert_messages(self, rows: List[Tuple], hits: List[Tuple] = ()):
+        """Bulk insert of (chat_id, message_id, user_id, username, text, date) rows,
+        plus their keyword hits as (chat_id, message_id, user_id, username, matched,
+        text, date), in one transaction."""
+        with self._con() as con:
+            con.executemany(
                 "INSERT INTO messages(chat_id, message_id, user_id, username, text, date) "
                 "VALUES (?,?,?,?,?,?)",
-                (chat_id, message_id, user_id, username, text, date),
+                rows,
             )
+            if hits:
+                con.executemany(
+                    "INSERT INTO keyword_hits(chat_id, message_id, user_id, username, matched, text, date) "
+                    "VALUES (?,?,?,?,?,?,?)",
+                    hits,
+                )
 
-    def get_messages(self, chat_id: int, since_ts: int) -> List[Dict]:
-        with sqlite3.connect(self.path) as con:
-            con.row_factory = sqlite3.Row
+    def iter_digest_lines(self, chat_id: int, since_ts: int) -> Iterator[str]:
+        """Stream the window oldest first as ready-made `- @user: text\n` digest
+        lines (formatted by SQLite); consume it in one thread."""
+        with self._con() as con:
             cur = con.execute(
-                "SELECT * FROM messages WHERE chat_id=? AND date>=? ORDER BY date ASC",
+                "SELECT '- @' || COALESCE(NULLIF(username, ''), user_id, 'None') || ': ' || text || char(10) "
+                "FROM messages WHERE chat_id=? AND date>=? ORDER BY date ASC",
                 (chat_id, since_ts),
             )
-            return [dict(r) for r in cur.fetchall()]
+            for (line,) in cur:
+                yield line
 
-    def top_users(self, chat_id: int, since_ts: int, limit: int = 10) -> List[Dict]:
-        with sqlite3.connect(self.path) as con:
-            con.row_factory = sqlite3.Row
-            cur = con.execute(
-                "SELECT user_id, username, COUNT(*) AS cnt "
-                "FROM messages WHERE chat_id=? AND date>=? "
-                "GROUP BY user_id, username ORDER BY cnt DESC LIMIT ?",
-                (chat_id, since_ts, limit),
-            )
-            return [dict(r) for r in cur.fetchall()]
+    def user_stats(self, chat_id: int, since_ts: int, limit: int = 10) -> Tuple[int, List[sqlite3.Row]]:
+        """(total messages, top `limit` users by count) for the window. Whole UTC
+        days come from user_daily; only the partial first day is counted from
+        messages. The window SUM runs over every group before LIMIT applies.
+
+        user_daily is pruned (prune_user_daily) to the /stats window, so a
+        window reaching past the oldest rollup day this chat still has is
+        grouped straight from messages instead."""
+        first_day = -(-since_ts // 86400)  # first day fully inside the window
+        with self._con() as con:
+            covered = con.execute(
+                "SELECT 1 FROM user_daily WHERE chat_id=? AND day<=? LIMIT 1", (chat_id, first_day)
+            ).fetchone()
+            if covered:
+                cur = con.execute(
+                    "WITH counts AS ("
+                    "  SELECT user_id, username, cnt FROM user_daily WHERE chat_id=? AND day>=? "
+                    "  UNION ALL "
+                    "  SELECT IFNULL(user_id, 0), IFNULL(username, ''), COUNT(*) FROM messages "
+                    "  WHERE chat_id=? AND date>=? AND date<? GROUP BY 1, 2"
+                    ") "
+                    "SELECT NULLIF(user_id, 0) AS user_id, NULLIF(username, '') AS username, "
+                    "SUM(cnt) AS cnt, SUM(SUM(cnt)) OVER () AS total "
+                    "FROM counts GROUP BY user_id, username ORDER BY cnt DESC LIMIT ?",
+                    (chat_id, first_day, chat_id, since_ts, first_day * 86400, limit),
+                )
+            else:
+                cur = con.execute(
+                    "SELECT user_id, username, COUNT(*) AS cnt, SUM(COUNT(*)) OVER () AS total "
+                    "FROM messages WHERE chat_id=? AND date>=? "
+                    "GROUP BY user_id, username ORDER BY cnt DESC LIMIT ?",
+                    (chat_id, since_ts, limit),
+                )
+            rows = cur.fetchall()
+            return (rows[0]["total"] if rows else 0), rows
 
     def count_messages(self, chat_id: int, since_ts: int) -> int:
-        with sqlite3.connect(self.path) as con:
+        with self._con() as con:
             cur = con.execute("SELECT COUNT(*) FROM messages WHERE chat_id=? AND date>=?", (chat_id, since_ts))
             row = cur.fetchone()
             return row[0] if row else 0
 
-    def search(self, chat_id: int, query: str, limit: int = 20) -> List[Dict]:
-        with sqlite3.connect(self.path) as con:
-            con.row_factory = sqlite3.Row
+    def window_fingerprint(self, chat_id: int, since_ts: int) -> Tuple[int, int | None, int | None]:
+        """(count, first id, last id) of the window; equal fingerprints mean equal message sets."""
+        with self._con() as con:
+            cur = con.execute(
+                "SELECT COUNT(*), MIN(id), MAX(id) FROM messages WHERE chat_id=? AND date>=?",
+                (chat_id, since_ts),
+            )
+            return tuple(cur.fetchone())
+
+    def search(self, chat_id: int, query: str, limit: int = 20, snippet_chars: int = 300) -> List[sqlite3.Row]:
+        """Rows carry a preformatted local `ts` and a `snippet` clipped to
+        snippet_chars + 1 characters (so callers can tell whether it was cut).
+
+        `@username` returns that user's latest messages; an all-digit query is
+        tried as a user id first and falls back to text search."""
+        m = _USER_QUERY_RE.fullmatch(query.strip())
+        # Longer digit runs (phone/account numbers) can't be a user id and
+        # would overflow SQLite's INTEGER; those go to text search.
+        if m and (m.group(1) or int(m.group(2)) <= _MAX_SQLITE_INT):
+            rows = self._search_user(chat_id, m.group(1), m.group(2), limit, snippet_chars)
+            if rows or m.group(1):
+                return rows
+        match = fts_query(query)
+        if not match:
+            return []
+        # FTS drives the join: MATCH yields rowids, each is looked up by primary
+        # key and filtered to this chat, so a quiet chat's matches are never
+        # crowded out by busier chats.
+        with self._con() as con:
+            cur = con.execute(
+                "SELECT " + _SEARCH_COLS +
+                "FROM fts_messages f JOIN messages m ON m.id = f.rowid "
+                "WHERE fts_messages MATCH ? AND m.chat_id=? "
+                "ORDER BY bm25(fts_messages) LIMIT ?",
+                (snippet_chars + 1, match, chat_id, limit),
+            )
+            return cur.fetchall()
+
+    def _search_user(self, chat_id: int, username: str | None, user_id: str | None,
+                     limit: int, snippet_chars: int) -> List[sqlite3.Row]:
+        if username:
+            where, arg = "m.username=? COLLATE NOCASE", username
+        else:
+            where, arg = "m.user_id=?", int(user_id)
+        with self._con() as con:
             cur = con.execute(
-                "SELECT m.* FROM fts_messages f "
-                "JOIN messages m ON m.id = f.rowid "
-                "WHERE m.chat_id=? AND f.text MATCH ? "
-                "ORDER BY m.date DESC LIMIT ?",
-                (chat_id, query, limit),
+                "SELECT " + _SEARCH_COLS + "FROM messages m "
+                "WHERE m.chat_id=? AND " + where + " ORDER BY m.date DESC LIMIT ?",
+                (snippet_chars + 1, chat_id, arg, limit),
             )
-            return [dict(r) for r in cur.fetchall()]
+            return cur.fetchall()
 
     # ---------------- settings ----------------
+    def _chat_settings(self, chat_id: int) -> Tuple:
+        """(digest_time, keywords, admin_user_id, inspire_time, inspire_threshold), cached."""
+        row = self._settings.get(chat_id)
+        if row is None:
+            with self._settings_lock:
+                row = self._settings.get(chat_id)
+                if row is None:
+                    with self._con() as con:
+                        r = con.execute(
+                            "SELECT digest_time, keywords, admin_user_id, inspire_time, inspire_threshold "
+                            "FROM chat_settings WHERE chat_id=?",
+                            (chat_id,),
+                        ).fetchone()
+                    if r is None:
+                        row = (None, "", None, None, None)
+                    else:
+                        row = (r[0], (r[1] or "").strip(), r[2], r[3], r[4])
+                    self._settings[chat_id] = row
+        return row
+
+    def _forget_settings(self, chat_id: int):
+        # Taken under the lock so a load that raced the write can't be kept.
+        with self._settings_lock:
+            self._settings.pop(chat_id, None)
+
+    def _upsert_setting(self, column: str, chat_id: int, value):
+        with self._con() as con:
+            con.execute(_SETTING_UPSERT[column], (chat_id, value))
+        self._forget_settings(chat_id)
+
     def set_digest_time(self, chat_id: int, time_str: str):
-        with sqlite3.connect(self.path) as con:
-            con.execute(
-                "INSERT INTO chat_settings(chat_id, digest_time) VALUES (?,?) "
-                "ON CONFLICT(chat_id) DO UPDATE SET digest_time=excluded.digest_time",
-                (chat_id, time_str),
-            )
+        self._upsert_setting("digest_time", chat_id, time_str)
 
     def get_digest_time(self, chat_id: int) -> str | None:
-        with sqlite3.connect(self.path) as con:
-            cur = con.execute("SELECT digest_time FROM chat_settings WHERE chat_id=?", (chat_id,))
-            row = cur.fetchone()
-            return row[0] if row else None
+        return self._chat_settings(chat_id)[0]
 
     def set_keywords(self, chat_id: int, kws: str):
-        with sqlite3.connect(self.path) as con:
-            con.execute(
-                "INSERT INTO chat_settings(chat_id, keywords) VALUES (?,?) "
-                "ON CONFLICT(chat_id) DO UPDATE SET keywords=excluded.keywords",
-                (chat_id, kws),
-            )
+        self._upsert_setting("keywords", chat_id, kws)
 
     def get_keywords(self, chat_id: int) -> str:
-        with sqlite3.connect(self.path) as con:
-            cur = con.execute("SELECT keywords FROM chat_settings WHERE chat_id=?", (chat_id,))
-            row = cur.fetchone()
-            return row[0].strip() if row and row[0] else ""
+        return self._chat_settings(chat_id)[1]
 
     # admin → DM routing
     def set_admin(self, chat_id: int, admin_user_id: int):
-        with sqlite3.connect(self.path) as con:
-            con.execute(
-                "INSERT INTO chat_settings(chat_id, admin_user_id) VALUES (?,?) "
-                "ON CONFLICT(chat_id) DO UPDATE SET admin_user_id=excluded.admin_user_id",
-                (chat_id, admin_user_id),
-            )
+        self._upsert_setting("admin_user_id", chat_id, admin_user_id)
 
     def get_admin(self, chat_id: int) -> int | None:
-        with sqlite3.connect(self.path) as con:
-            cur = con.execute("SELECT admin_user_id FROM chat_settings WHERE chat_id=?", (chat_id,))
-            row = cur.fetchone()
-            return row[0] if row else None
+        return self._chat_settings(chat_id)[2]
 
     # inspire (NEW)
     def set_inspire(self, chat_id: int, time_str: str, threshold: int):
-        with sqlite3.connect(self.path) as con:
+        with self._con() as con:
             con.execute(
                 "INSERT INTO chat_settings(chat_id, inspire_time, inspire_threshold) VALUES (?,?,?) "
                 "ON CONFLICT(chat_id) DO UPDATE SET "
@@ -175,33 +384,24 @@ class Storage:
                 "inspire_threshold=excluded.inspire_threshold",
                 (chat_id, time_str, threshold),
             )
+        self._forget_settings(chat_id)
 
     def get_inspire(self, chat_id: int) -> Tuple[str | None, int | None]:
-        with sqlite3.connect(self.path) as con:
-            cur = con.execute("SELECT inspire_time, inspire_threshold FROM chat_settings WHERE chat_id=?", (chat_id,))
-            row = cur.fetchone()
-            return (row[0], row[1]) if row else (None, None)
+        return self._chat_settings(chat_id)[3:5]
 
-    def all_chats(self) -> List[int]:
-        with sqlite3.connect(self.path) as con:
+    def all_schedules(self) -> List[Tuple[int, str | None, str | None]]:
+        """(chat_id, digest_time, inspire_time) for every known chat in one query."""
+        with self._con() as con:
             cur = con.execute(
-                "SELECT DISTINCT chat_id FROM messages "
-                "UNION SELECT DISTINCT chat_id FROM chat_settings"
+                "SELECT c.chat_id, s.digest_time, s.inspire_time FROM ("
+                "  SELECT DISTINCT chat_id FROM messages UNION SELECT chat_id FROM chat_settings"
+                ") c LEFT JOIN chat_settings s ON s.chat_id = c.chat_id"
             )
-            return [r[0] for r in cur.fetchall()]
+            return [tuple(r) for r in cur.fetchall()]
 
     # ---------------- keyword hits (optional analytics) ----------------
-    def insert_keyword_hit(self, chat_id: int, message_id: int, user_id: int, username: str,
-                           matched: str, text: str, date: int):
-        with sqlite3.connect(self.path) as con:
-            con.execute(
-                "INSERT INTO keyword_hits(chat_id, message_id, user_id, username, matched, text, date) "
-                "VALUES (?,?,?,?,?,?,?)",
-                (chat_id, message_id, user_id, username, matched, text, date),
-            )
-
     def count_hits(self, chat_id: int, since_ts: int) -> int:
-        with sqlite3.connect(self.path) as con:
+        with self._con() as con:
             cur = con.execute(
                 "SELECT COUNT(*) FROM keyword_hits WHERE chat_id=? AND date>=?",
                 (chat_id, since_ts),
@@ -209,11 +409,73 @@ class Storage:
             row = cur.fetchone()
             return row[0] if row else 0
 
-    def get_hits(self, chat_id: int, since_ts: int) -> List[Dict]:
-        with sqlite3.connect(self.path) as con:
-            con.row_factory = sqlite3.Row
-            cur = con.execute(
+    def iter_hits(self, chat_id: int, since_ts: int) -> Iterator[sqlite3.Row]:
+        """Stream hits row by row; consume it in the thread that created it."""
+        with self._con() as con:
+            yield from con.execute(
                 "SELECT * FROM keyword_hits WHERE chat_id=? AND date>=? ORDER BY date ASC",
                 (chat_id, since_ts),
             )
-            return [dict(r) for r in cur.fetchall()]
+
+    # ---------------- digest cache ----------------
+    def get_cached_digest(self, key: str) -> str | None:
+        with self._con() as con:
+            cur = con.execute("SELECT md FROM digest_cache WHERE key=?", (key,))
+            row = cur.fetchone()
+            return row[0] if row else None
+
+    def put_cached_digest(self, key: str, md: str, created_at: int):
+        with self._con() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO digest_cache(key, md, created_at) VALUES (?,?,?)",
+                (key, md, created_at),
+            )
+
+    def purge_digest_cache(self, older_than_ts: int):
+        with self._con() as con:
+            con.execute("DELETE FROM digest_cache WHERE created_at<?", (older_than_ts,))
+
+    # ---------------- maintenance ----------------
+    def prune_user_daily(self, before_ts: int):
+        """Drop rollup days that no stats window reaches any more."""
+        with self._con() as con:
+            con.execute("DELETE FROM user_daily WHERE day<?", (before_ts // 86400,))
+
+    def archive_messages(self, before_ts: int, archive_path: str) -> int:
+        """Move messages older than before_ts into archive_path (same layout,
+        no FTS) so the live table stays digest-sized. Returns rows moved.
+
+        Rows go over in id order, ARCHIVE_BATCH at a time with a commit per
+        batch, so the writer queue is never locked out for the whole move."""
+        con = self._con()
+        con.execute("ATTACH DATABASE ? AS arc", (archive_path,))
+        batch = "SELECT id FROM main.messages WHERE date<? ORDER BY id LIMIT ?"
+        moved = 0
+        try:
+            with con:
+                con.execute(
+                    "CREATE TABLE IF NOT EXISTS arc.messages ("
+                    "id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, "
+                    "user_id INTEGER, username TEXT, text TEXT NOT NULL, date INTEGER NOT NULL)"
+                )
+            while True:
+                with con:
+                    con.execute("INSERT OR IGNORE INTO arc.messages SELECT * FROM main.messages "
+                                "WHERE id IN (" + batch + ")", (before_ts, ARCHIVE_BATCH))
+                    n = con.execute("DELETE FROM main.messages WHERE id IN (" + batch + ")",
+                                    (before_ts, ARCHIVE_BATCH)).rowcount
+                moved += n
+                if n < ARCHIVE_BATCH:
+                    break
+        finally:
+            con.execute("DETACH DATABASE arc")
+        if moved:
+            con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return moved
+
+    def analyze(self):
+        """Refresh planner stats as busy and quiet chats drift apart. The
+        analysis limit keeps it to a sample so it stays cheap on large DBs."""
+        with self._con() as con:
+            con.execute("PRAGMA analysis_limit=1000")
+            con.execute("ANALYZE main")
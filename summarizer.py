@@ -1,5 +1,7 @@
+import asyncio
 import re
-from typing import List, Dict
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
 
 SYSTEM_PROMPT = (
     "Siz — Telegram guruhining diqqatli kotibisiz. Muhokamalar bo'yicha qisqa xulosa chiqaring., "
@@ -7,79 +9,95 @@ SYSTEM_PROMPT = (
     "Yakunda (agar mavjud bo'lsa) Todo ro'yxatini va xavf/to'siqlar bo'limini qo'sh."
 )
 
-def chunk_messages(msgs: List[Dict], max_chars: int = 8000) -> List[str]:
+def chunk_messages(lines: Iterable[str], max_chars: int = 8000) -> List[str]:
+    """Pack preformatted `- @user: text\n` lines into blocks of up to max_chars."""
     blocks = []
-    current = ""
-    for m in msgs:
-        line = f"- @{m.get('username') or m.get('user_id')}: {m['text']}\n"
-        if len(current) + len(line) > max_chars:
-            if current:
-                blocks.append(current)
-            current = line
-        else:
-            current += line
-    if current:
-        blocks.append(current)
+    buf, size = [], 0
+    for line in lines:
+        if size + len(line) > max_chars and buf:
+            blocks.append("".join(buf))
+            buf, size = [], 0
+        buf.append(line)
+        size += len(line)
+    if buf:
+        blocks.append("".join(buf))
     return blocks
 
-async def summarize_window(client, model: str, msgs: List[Dict], period_label: str) -> str:
-    from openai import AsyncOpenAI
-    try:
-        aclient = AsyncOpenAI(api_key=client.api_key)
-        blocks = chunk_messages(msgs)
-        partial_summaries = []
-        for i, block in enumerate(blocks, 1):
-            resp = await aclient.chat.completions.create(
-                model=model,
-                temperature=0.2,
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": f"Суммируй блок {i}/{len(blocks)} {period_label}:\n{block}"}
-                ]
-            )
-            partial_summaries.append(resp.choices[0].message.content.strip())
-        final_input = "\n\n".join(f"Блок {i+1}: {s}" for i, s in enumerate(partial_summaries))
-        final = await aclient.chat.completions.create(
-            model=model,
-            temperature=0.2,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": f"Собери общий краткий дайджест {period_label} по блокам ниже.\n{final_input}"}
-            ]
-        )
-        return final.choices[0].message.content.strip()
-    except Exception:
-        blocks = chunk_messages(msgs)
-        partial_summaries = []
-        for i, block in enumerate(blocks, 1):
-            resp = client.chat.completions.create(
-                model=model,
-                temperature=0.2,
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": f"Суммируй блок {i}/{len(blocks)} {period_label}:\n{block}"}
-                ]
-            )
-            partial_summaries.append(resp.choices[0].message.content.strip())
-        final_input = "\n\n".join(f"Блок {i+1}: {s}" for i, s in enumerate(partial_summaries))
-        final = client.chat.completions.create(
-            model=model,
-            temperature=0.2,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": f"Собери общий краткий дайджест {period_label} по блокам ниже.\n{final_input}"}
-            ]
-        )
-        return final.choices[0].message.content.strip()
+MAP_CONCURRENCY = 5  # concurrent block summaries per digest (OpenAI rate limits)
+
+async def _complete(aclient, model: str, content: str) -> str:
+    resp = await aclient.chat.completions.create(
+        model=model,
+        temperature=0.2,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": content}
+        ]
+    )
+    return resp.choices[0].message.content.strip()
+
+async def summarize_window(aclient, model: str, lines: Iterable[str], period_label: str) -> str:
+    """Map-reduce digest: blocks are summarized concurrently, then merged in one call.
+    A window that fits in a single block needs no merge step. `lines` may be a
+    lazy cursor; it is consumed once, in a worker thread."""
+    # Draining a busy week's cursor into blocks is real work; keep it off the loop.
+    blocks = await asyncio.to_thread(chunk_messages, lines)
+    sem = asyncio.Semaphore(MAP_CONCURRENCY)
+
+    async def summarize_block(i: int, block: str) -> str:
+        async with sem:
+            return await _complete(aclient, model, f"Суммируй блок {i}/{len(blocks)} {period_label}:\n{block}")
+
+    partial_summaries = await asyncio.gather(*(summarize_block(i, b) for i, b in enumerate(blocks, 1)))
+    if len(partial_summaries) == 1:
+        return partial_summaries[0]
+    final_input = "\n\n".join(f"Блок {i+1}: {s}" for i, s in enumerate(partial_summaries))
+    return await _complete(aclient, model, f"Собери общий краткий дайджест {period_label} по блокам ниже.\n{final_input}")
+
+_KeywordPatterns = Tuple[Tuple[str, re.Pattern], ...]
+
+@lru_cache(maxsize=256)
+def _compile_keywords(keywords_csv: str) -> Tuple[Tuple[str, ...], re.Pattern | None,
+                                                  Dict[int, List[Tuple[str, re.Pattern]]], _KeywordPatterns]:
+    """Compile a keywords CSV once into a single alternation scanned in one pass.
+
+    The zero-width lookahead lets keywords that start inside another match
+    still be found; alternatives are longest-first, so a keyword that can
+    match a prefix of a longer one may be shadowed at the same position and
+    gets its own pattern instead (usually none). Each match is mapped back to
+    keywords by a case-insensitive fullmatch, since str.lower() does not agree
+    with re.IGNORECASE for letters like "İ" or "ſ".
+    """
+    kws = tuple(k for k in (raw.strip() for raw in keywords_csv.split(",")) if k)
+    if not kws:
+        return (), None, {}, ()
+    uniq = sorted(dict.fromkeys(kws), key=len, reverse=True)
+    exact = {k: re.compile(re.escape(k), flags=re.IGNORECASE) for k in uniq}
+    alt = "|".join(re.escape(k) for k in uniq)
+    pattern = re.compile(rf"(?=\b({alt})\b)", flags=re.IGNORECASE)
+    by_len: Dict[int, List[Tuple[str, re.Pattern]]] = {}
+    for k, pat in exact.items():
+        by_len.setdefault(len(k), []).append((k, pat))
+    prefixes = tuple(
+        (k, re.compile(rf"\b{re.escape(k)}\b", flags=re.IGNORECASE))
+        for k in uniq
+        if any(len(o) > len(k) and exact[k].fullmatch(o, 0, len(k)) for o in uniq)
+    )
+    return kws, pattern, by_len, prefixes
 
 def build_keyword_flags(text: str, keywords_csv: str):
     if not keywords_csv:
         return []
-    hits = []
-    for raw in keywords_csv.split(","):
-        k = raw.strip()
-        if not k:
-            continue
-        if re.search(rf"\b{re.escape(k)}\b", text, flags=re.IGNORECASE):
-            hits.append(k)
-    return hits
+    kws, pattern, by_len, prefixes = _compile_keywords(keywords_csv)
+    if pattern is None:
+        return []
+    found = set()
+    for m in pattern.finditer(text):
+        hit = m.group(1)
+        for k, pat in by_len.get(len(hit), ()):
+            if k not in found and pat.fullmatch(hit):
+                found.add(k)
+    for k, pat in prefixes:
+        if k not in found and pat.search(text):
+            found.add(k)
+    return [k for k in kws if k in found]
@@ -0,0 +1,95 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import Storage
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.storage = Storage(os.path.join(self._tmp.name, "db", "bot.db"))
+
+
+class SearchTest(StorageTestCase):
+    def test_long_digit_query_falls_back_to_text_search(self):
+        number = "99999999999999999999999"
+        self.storage.insert_messages([(-100, 1, 42, "alice", f"account {number}", 1_700_000_000)])
+        rows = self.storage.search(-100, number)
+        self.assertEqual([r["message_id"] for r in rows], [1])
+
+    def test_digit_query_matches_user_id(self):
+        self.storage.insert_messages([(-100, 1, 42, "alice", "hello", 1_700_000_000)])
+        self.assertEqual([r["user_id"] for r in self.storage.search(-100, "42")], [42])
+        self.assertEqual(self.storage.search(-100, str(2**63 - 1)), [])
+
+
+def baseline_user_stats(con, chat_id, since_ts):
+    """The GROUP BY over messages that user_stats served before the rollup."""
+    rows = con.execute(
+        "SELECT user_id, username, COUNT(*) AS cnt, SUM(COUNT(*)) OVER () AS total "
+        "FROM messages WHERE chat_id=? AND date>=? GROUP BY user_id, username",
+        (chat_id, since_ts),
+    ).fetchall()
+    return (rows[0]["total"] if rows else 0), rows
+
+
+class UserStatsTest(StorageTestCase):
+    DAY0 = 19_700 * 86400
+
+    def assertMatchesBaseline(self, chat_id, since_ts):
+        total, rows = self.storage.user_stats(chat_id, since_ts, limit=1000)
+        base_total, base_rows = baseline_user_stats(self.storage._con(), chat_id, since_ts)
+        self.assertEqual(total, base_total)
+        self.assertEqual(sorted(((r["user_id"], r["username"], r["cnt"]) for r in rows), key=str),
+                         sorted(((r["user_id"], r["username"], r["cnt"]) for r in base_rows), key=str))
+        top, limited = self.storage.user_stats(chat_id, since_ts, limit=3)
+        self.assertEqual(top, base_total)
+        self.assertEqual([r["cnt"] for r in limited],
+                         sorted((r["cnt"] for r in base_rows), reverse=True)[:3])
+
+    def test_matches_group_by(self):
+        rng = random.Random(42)
+        users = [(1, "alice"), (1, "Alice"), (2, "bob"), (3, None), (None, None), (None, "anon")]
+        rows = []
+        for i in range(2000):
+            user_id, username = rng.choice(users)
+            chat_id = rng.choice((-100, -200))
+            rows.append((chat_id, i, user_id, username, "hi", self.DAY0 + rng.randrange(6 * 86400)))
+        self.storage.insert_messages(rows)
+        windows = [self.DAY0 - 1, self.DAY0, self.DAY0 + 86400, self.DAY0 + 86400 + 1,
+                   self.DAY0 + 3 * 86400 + 43_200, self.DAY0 + 6 * 86400, self.DAY0 + 7 * 86400]
+        for since_ts in windows:
+            for chat_id in (-100, -200, -300):
+                with self.subTest(chat_id=chat_id, since_ts=since_ts):
+                    self.assertMatchesBaseline(chat_id, since_ts)
+
+        # Deletes (archiving, FTS maintenance) must keep the rollup in step.
+        with self.storage._con() as con:
+            con.execute("DELETE FROM messages WHERE id % 3 = 0 OR (user_id=2 AND date<?)",
+                        (self.DAY0 + 4 * 86400,))
+        for since_ts in windows:
+            with self.subTest(after_delete=True, since_ts=since_ts):
+                self.assertMatchesBaseline(-100, since_ts)
+
+    def test_window_older_than_pruned_rollup(self):
+        rng = random.Random(7)
+        self.storage.insert_messages([
+            (-100, i, rng.choice((1, 2, None)), rng.choice(("a", None)), "hi",
+             self.DAY0 + rng.randrange(10 * 86400))
+            for i in range(1000)
+        ])
+        self.storage.prune_user_daily(self.DAY0 + 5 * 86400)
+        for since_ts in (self.DAY0, self.DAY0 + 2 * 86400 + 3600, self.DAY0 + 5 * 86400 - 1,
+                         self.DAY0 + 5 * 86400, self.DAY0 + 8 * 86400 + 1):
+            with self.subTest(since_ts=since_ts):
+                self.assertMatchesBaseline(-100, since_ts)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import random
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from summarizer import build_keyword_flags
+
+
+def baseline_keyword_flags(text, keywords_csv):
+    """The original one-search-per-keyword implementation."""
+    out = []
+    for raw in keywords_csv.split(","):
+        k = raw.strip()
+        if k and re.search(rf"\b{re.escape(k)}\b", text, re.I):
+            out.append(k)
+    return out
+
+
+class KeywordFlagsTest(unittest.TestCase):
+    CASES = [
+        # prefixes of other keywords
+        ("deadline", "dead,deadline,line"),
+        ("dead line", "dead,deadline,line"),
+        ("the deadlines", "dead,deadline"),
+        # overlapping keywords
+        ("new york city", "new york,york city,city"),
+        ("a-b-c", "a-b,b-c,a-b-c"),
+        ("c++ and c#", "c,c++,c#"),
+        # case folding that str.lower() and re.IGNORECASE disagree on
+        ("İstanbul", "i̇stanbul,İstanbul,istanbul"),
+        ("İ", "i,i̇,İ"),
+        ("ſ", "s,S,ſ"),
+        ("ſtraße", "straße,STRASSE,ſtraße"),
+        ("KELVIN K", "k,K"),
+        # duplicates, blanks, and punctuation-edged keywords
+        ("urgent URGENT", "urgent, Urgent ,,urgent"),
+        ("done!", "done!,done"),
+        ("", "a,b"),
+        ("anything", " , "),
+    ]
+
+    def test_matches_baseline(self):
+        for text, kws in self.CASES:
+            with self.subTest(text=text, keywords=kws):
+                self.assertEqual(build_keyword_flags(text, kws), baseline_keyword_flags(text, kws))
+
+    def test_matches_baseline_randomized(self):
+        rng = random.Random(1234)
+        alphabet = ["a", "b", "A", "B", "ab", " ", "-", "_", "1", "İ", "i", "ſ", "s", "S", "K", "k", "."]
+        for _ in range(3000):
+            text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+            kws = ",".join(
+                "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4)))
+                for _ in range(rng.randint(1, 5))
+            )
+            with self.subTest(text=text, keywords=kws):
+                self.assertEqual(build_keyword_flags(text, kws), baseline_keyword_flags(text, kws))
+
+
+if __name__ == "__main__":
+    unittest.main()